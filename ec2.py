@@ -1,69 +1,149 @@
+import json
+import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import cached_property
+from typing import Optional
+
 import boto3
-from botocore.exceptions import ClientError
+from botocore.config import Config
+from botocore.exceptions import ClientError, WaiterError
+
+# Previous generation instance families that do not support EBS encryption
+UNSUPPORTED_INSTANCE_FAMILIES = frozenset({'c1', 'm1', 'm2', 't1'})
+
+
+def to_tag_list(tags_by_key: dict) -> list[dict]:
+    """ Converts a {key: value} tag dict back into the Key/Value list the EC2 API expects """
+    return [{'Key': key, 'Value': value} for key, value in tags_by_key.items()]
+
+
+@dataclass(slots=True)
+class VolCtx:
+    """ Per-volume state built once by get_ebs_list and filled in as each step of the encryption runs """
+    volume_id: str
+    device_name: str
+    volume_type: str
+    tags: dict = field(default_factory=dict)
+    snapshot_id: Optional[str] = None
+    new_volume_id: Optional[str] = None
 
 
 class EncryptEC2:
-    def __init__(self, instance_id: str, region: str = 'us-east-1', profile: str = 'default', key: str = 'alias/aws/ebs'):
+    def __init__(self, instance_id: str, region: str = 'us-east-1', profile: str = 'default', key: str = 'alias/aws/ebs',
+                 snapshot_before_stop: bool = False, use_state_events: bool = False):
         session = boto3.session.Session(profile_name=profile, region_name=region)
 
         self.instance_id = instance_id
         self.key = key
-        self._ec2_client = session.client('ec2')
-        # self._ec2_details = self._ec2_client.describe_instances(InstanceIds=[instance_id])
-        self._ec2_resource = session.resource('ec2')
+        # Snapshots taken while the instance is still running are only crash-consistent and miss any writes made
+        # between snapshot creation and stop. In exchange the snapshot time overlaps the stop and detach waits.
+        self.snapshot_before_stop = snapshot_before_stop
+        # Waits for the instance to stop on EventBridge state-change events delivered to a temporary SQS queue
+        # instead of polling DescribeInstances. Needs events:* and sqs:* permissions on top of the EC2 ones.
+        self.use_state_events = use_state_events
+        # Enough pooled connections for the parallel snapshot/volume calls; adaptive retries absorb throttling
+        self._ec2_client = session.client('ec2', config=Config(
+            max_pool_connections=32,
+            retries={'mode': 'adaptive', 'max_attempts': 10},
+            tcp_keepalive=True
+        ))
         self._ec2_stop_waiter = self._ec2_client.get_waiter('instance_stopped')
         self._ebs_available_waiter = self._ec2_client.get_waiter('volume_available')
         self._snapshot_created_waiter = self._ec2_client.get_waiter('snapshot_completed')
         self._ec2_status_check_waiter = self._ec2_client.get_waiter('instance_status_ok')
+        if use_state_events:
+            self._events_client = session.client('events')
+            self._sqs_client = session.client('sqs')
+            self._state_events_name = None
+            self._state_queue_url = None
+            # Seconds to wait for the "stopped" event before falling back to the polling waiter
+            self._state_event_timeout = 300
 
-        self._delay = 5
+        # Waiter backoff: base * 2**tries seconds, capped at max_delay, plus up to jitter seconds
+        self._base_delay = 1
+        self._max_delay = 30
+        self._jitter = 1
         self._max_attempts = 60
+        self._max_workers = 8
 
         if self.pre_checks():
             self._pre_checks_passed = True
             print("-- Pre checks passed")
-            self._ec2_details = self._ec2_client.describe_instances(InstanceIds=[instance_id])
         else:
             # Exits the whole execution if pre-checks fails
             self._pre_checks_passed = False
 
-    def get_ebs_list(self) -> list[dict]:
+    @cached_property
+    def _ec2_details(self) -> dict:
+        """ Instance description, fetched once and reused by every step.
+        None of the fields read from it change across a stop/start cycle. """
+        return self._ec2_client.describe_instances(InstanceIds=[self.instance_id])['Reservations'][0]['Instances'][0]
+
+    @cached_property
+    def instance_type(self) -> str:
+        return self._ec2_details['InstanceType']
+
+    @cached_property
+    def availability_zone(self) -> str:
+        """ Returns availability zone of the instance """
+        return self._ec2_details['Placement']['AvailabilityZone']
+
+    def get_ebs_list(self) -> list[VolCtx]:
         """Returns list of unencrypted volume details"""
-        volume_ids = []
-        describe_ec2 = self._ec2_client.describe_instances(InstanceIds=[self.instance_id])
-        for ebs in describe_ec2['Reservations'][0]['Instances'][0]['BlockDeviceMappings']:
-            volume_id = ebs['Ebs']['VolumeId']
-            resp = self._ec2_client.describe_volumes(
-                VolumeIds=[volume_id]
-            )
-            for volume in resp['Volumes']:
-                if volume['Encrypted']:
-                    pass
-                else:
-                    volume_ids.append(resp['Volumes'][0])
-        return volume_ids
+        # DescribeVolumes takes up to 500 ids, so a single call covers every attached volume.
+        # The encrypted filter is applied server side, leaving only the volumes that need work.
+        all_ids = [ebs['Ebs']['VolumeId'] for ebs in self._ec2_details['BlockDeviceMappings']]
+        if not all_ids:
+            # An empty VolumeIds is dropped from the request, which would describe every volume in the region
+            return []
+        resp = self._ec2_client.describe_volumes(
+            VolumeIds=all_ids,
+            Filters=[
+                {
+                    'Name': 'encrypted',
+                    'Values': ['false']
+                }
+            ]
+        )
+        volumes = []
+        for volume in resp['Volumes']:
+            # Pulling tags into a dict once, excluding the ones that starts with keyword "aws" as aws blocks
+            # creating these manually
+            tags = {tag['Key']: tag['Value'] for tag in volume.get('Tags', []) if not tag['Key'].startswith('aws')}
+            tags['device-name'] = volume['Attachments'][0]['Device']
+            tags['volume-type'] = volume['VolumeType']
+            volumes.append(VolCtx(
+                volume_id=volume['VolumeId'],
+                device_name=tags['device-name'],
+                volume_type=tags['volume-type'],
+                tags=tags
+            ))
+        return volumes
 
     def pre_checks(self) -> bool:
         """ Checks if the EC2 exists or supports encrypted EBS volumes."""
         print("-- Performing pre checks")
         try:
+            # Checks if the instance type supports EBS encryption. Done first as it only needs the cached
+            # instance details, so unsupported instances never reach DescribeVolumes.
+            instance_type = self.instance_type
+            if instance_type.split('.')[0] in UNSUPPORTED_INSTANCE_FAMILIES:
+                print(f"Instance type {instance_type} is not supported for encryption")
+                return False
+
             # Checks if all volumes are already encrypted.
-            if self.get_ebs_list():
+            self._unencrypted_volumes = self.get_ebs_list()
+            if self._unencrypted_volumes:
                 # Function : get_ebs_list returns list of unencrypted volumes. Thus if it returns, this check passed.
-                pass
+                return True
             else:
                 # get_ebs_list returns nothing and thus meaning there are no unencrypted EBS volumes present
                 print("All volumes are already encrypted")
                 return False
 
-            # Checks if the instance type supports EBS encryption
-            instance_type = self._ec2_client.describe_instances(InstanceIds=[self.instance_id])['Reservations'][0]['Instances'][0]['InstanceType']
-            if instance_type.startswith(('c1', 'm1', 'm2', 't1')):
-                print(f"Instance type {instance_type} is not supported for encryption")
-                return False
-            else:
-                return True
-
         except ClientError as err:
             if err.response['Error']['Code'] == 'InvalidInstanceID.Malformed':
                 print(f"Instance : {self.instance_id} not found")
@@ -71,107 +151,192 @@ class EncryptEC2:
             else:
                 print(err)
 
-    def get_az(self) -> str:
-        """ Returns availability zone of the instance """
-        return self._ec2_details['Reservations'][0]['Instances'][0]['Placement']['AvailabilityZone']
+    def _wait(self, waiter, **kwargs) -> None:
+        """ Polls the waiter with exponential backoff and jitter instead of a fixed delay """
+        for tries in range(self._max_attempts):
+            try:
+                # A single attempt per call so the sleep between polls is ours to choose
+                waiter.wait(WaiterConfig={'Delay': 0, 'MaxAttempts': 1}, **kwargs)
+                return
+            except WaiterError as err:
+                if not err.kwargs.get('reason', '').startswith('Max attempts exceeded') or tries == self._max_attempts - 1:
+                    raise
+            time.sleep(min(self._max_delay, self._base_delay * 2 ** min(tries, 5)) + random.uniform(0, self._jitter))
 
-    def stop_instance(self) -> None:
-        """ Stops EC2 Instance and wait for it to be in stopped state"""
-        print(f"-- Stopping {self.instance_id}")
-        self._ec2_client.stop_instances(
-            InstanceIds=[
-                self.instance_id,
-            ]
-        )
-        self._ec2_stop_waiter.wait(
-            InstanceIds=[
-                self.instance_id,
-            ],
-            WaiterConfig={
-                'Delay': self._delay,
-                'MaxAttempts': self._max_attempts
+    def setup_state_events(self) -> None:
+        """ Creates an SQS queue fed by an EventBridge rule matching state changes of this instance """
+        # Unique per run, as SQS refuses to recreate a queue name deleted in the last 60 seconds
+        self._state_events_name = f"encryptaws-{self.instance_id}-{uuid.uuid4().hex[:8]}"
+        self._state_queue_url = self._sqs_client.create_queue(QueueName=self._state_events_name)['QueueUrl']
+        queue_arn = self._sqs_client.get_queue_attributes(
+            QueueUrl=self._state_queue_url,
+            AttributeNames=['QueueArn']
+        )['Attributes']['QueueArn']
+        rule_arn = self._events_client.put_rule(
+            Name=self._state_events_name,
+            EventPattern=json.dumps({
+                'source': ['aws.ec2'],
+                'detail-type': ['EC2 Instance State-change Notification'],
+                'detail': {'instance-id': [self.instance_id]}
+            })
+        )['RuleArn']
+        self._sqs_client.set_queue_attributes(
+            QueueUrl=self._state_queue_url,
+            Attributes={
+                'Policy': json.dumps({
+                    'Version': '2012-10-17',
+                    'Statement': [
+                        {
+                            'Effect': 'Allow',
+                            'Principal': {'Service': 'events.amazonaws.com'},
+                            'Action': 'sqs:SendMessage',
+                            'Resource': queue_arn,
+                            'Condition': {'ArnEquals': {'aws:SourceArn': rule_arn}}
+                        }
+                    ]
+                })
             }
         )
-        print(f"-- {self.instance_id} stopped")
+        self._events_client.put_targets(
+            Rule=self._state_events_name,
+            Targets=[
+                {
+                    'Id': 'queue',
+                    'Arn': queue_arn
+                }
+            ]
+        )
 
-    def detach_volume(self):
-        """ Detach the EBS volumes attached to EC2, if they are unencrypted"""
-        volumes = self.get_ebs_list()
-        for item in volumes:
-            volume_id = item['VolumeId']
-            volume_type = item['VolumeType']
-            self._ec2_client.create_tags(
-                Resources=[
-                    volume_id,
-                ],
-                Tags=[
-                    {
-                        'Key': 'device-name',
-                        'Value': item['Attachments'][0]['Device']
-                    },
-                    {
-                        'Key': 'volume-type',
-                        'Value': volume_type
-                    }
+    def teardown_state_events(self) -> None:
+        """ Removes the EventBridge rule and SQS queue created by setup_state_events """
+        try:
+            self._events_client.remove_targets(Rule=self._state_events_name, Ids=['queue'])
+            self._events_client.delete_rule(Name=self._state_events_name)
+        except ClientError as err:
+            # The rule may not exist if setup failed part way through
+            print(err)
+        if self._state_queue_url:
+            try:
+                self._sqs_client.delete_queue(QueueUrl=self._state_queue_url)
+            except ClientError as err:
+                print(err)
+            self._state_queue_url = None
+
+    def _wait_for_state(self, state: str) -> bool:
+        """ Long-polls the state-change queue until the instance reports the given state.
+        Returns False if the state was not reached within the timeout. """
+        deadline = time.monotonic() + self._state_event_timeout
+        while time.monotonic() < deadline:
+            resp = self._sqs_client.receive_message(
+                QueueUrl=self._state_queue_url,
+                MaxNumberOfMessages=10,
+                WaitTimeSeconds=20
+            )
+            messages = resp.get('Messages', [])
+            reached = False
+            for message in messages:
+                self._sqs_client.delete_message(
+                    QueueUrl=self._state_queue_url,
+                    ReceiptHandle=message['ReceiptHandle']
+                )
+                if json.loads(message['Body'])['detail']['state'] == state:
+                    reached = True
+            if not messages:
+                # The event can be lost while the new rule or queue policy propagates, so after an empty
+                # long poll check the instance directly; one DescribeInstances per 20 seconds at most
+                current = self._ec2_client.describe_instances(
+                    InstanceIds=[self.instance_id]
+                )['Reservations'][0]['Instances'][0]['State']['Name']
+                reached = current == state
+            if reached:
+                return True
+        return False
+
+    def stop_instance(self) -> None:
+        """ Stops EC2 Instance and wait for it to be in stopped state"""
+        print(f"-- Stopping {self.instance_id}")
+        if self.use_state_events:
+            try:
+                self.setup_state_events()
+                resp = self._ec2_client.stop_instances(
+                    InstanceIds=[
+                        self.instance_id,
+                    ]
+                )
+                # An already stopped instance emits no state-change event
+                if resp['StoppingInstances'][0]['CurrentState']['Name'] != 'stopped':
+                    if not self._wait_for_state('stopped'):
+                        self._wait(
+                            self._ec2_stop_waiter,
+                            InstanceIds=[
+                                self.instance_id,
+                            ]
+                        )
+            finally:
+                self.teardown_state_events()
+        else:
+            self._ec2_client.stop_instances(
+                InstanceIds=[
+                    self.instance_id,
+                ]
+            )
+            self._wait(
+                self._ec2_stop_waiter,
+                InstanceIds=[
+                    self.instance_id,
                 ]
             )
-            print(f"-- Detaching {volume_id} : {item['Attachments'][0]['Device']}")
+        print(f"-- {self.instance_id} stopped")
+
+    def detach_volume(self, volumes: list[VolCtx]):
+        """ Detach the given unencrypted EBS volumes from the EC2"""
+        def detach(ctx):
+            print(f"-- Detaching {ctx.volume_id} : {ctx.device_name}")
             self._ec2_client.detach_volume(
                 InstanceId=self.instance_id,
-                VolumeId=volume_id
-            )
-            self._ebs_available_waiter.wait(
-                VolumeIds=[
-                    volume_id,
-                ],
-                WaiterConfig={
-                    'Delay': self._delay,
-                    'MaxAttempts': self._max_attempts
-                }
+                VolumeId=ctx.volume_id
             )
 
-    def create_snapshots(self, volume_ids: list) -> list:
-        created_snapshots = []
-        for volume in volume_ids:
-            volume_resource = self._ec2_resource.Volume(volume)
-
-            # Pulling tags and excluding the ones that starts with keyword "aws" as aws blocks creating these manually
-            final_tags = []
-            for tag in volume_resource.tags:
-                if tag['Key'].startswith('aws'):
-                    pass
-                else:
-                    final_tags.append(tag)
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            list(executor.map(detach, volumes))
+        # Detaches run concurrently, so one DescribeVolumes poll covers all of them
+        self._wait(
+            self._ebs_available_waiter,
+            VolumeIds=[ctx.volume_id for ctx in volumes]
+        )
+
+    def create_snapshots(self, volumes: list[VolCtx]) -> None:
+        """ Starts a snapshot of each volume, recording its id on the volume's context """
+        def snapshot(ctx):
             response = self._ec2_client.create_snapshot(
-                VolumeId=volume,
+                VolumeId=ctx.volume_id,
                 TagSpecifications=[
                     {
                         'ResourceType': 'snapshot',
-                        'Tags': final_tags
+                        'Tags': to_tag_list(ctx.tags)
                     }
                 ]
             )
-            self._snapshot_created_waiter.wait(
-                SnapshotIds=[
-                    response['SnapshotId'],
-                ],
-                WaiterConfig={
-                    'Delay': self._delay,
-                    'MaxAttempts': self._max_attempts
-                }
-            )
-            created_snapshots.append(response['SnapshotId'])
-            print(f"-- {response['SnapshotId']} created")
-        return created_snapshots
-
-    def create_volume(self, snapshot_ids: list, availability_zone: str) -> list:
-        created_volumes = []
-        for snapshot in snapshot_ids:
-            snapshot_resource = self._ec2_resource.Snapshot(snapshot)
-            volume_type = ''
-            for tag in snapshot_resource.tags:
-                if tag['Key'] == 'volume-type':
-                    volume_type = tag['Value']
+            ctx.snapshot_id = response['SnapshotId']
+
+        # Submit every snapshot up front; they progress in parallel on the AWS side
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            list(executor.map(snapshot, volumes))
+        print(f"-- Snapshots: {[ctx.snapshot_id for ctx in volumes]} started")
+
+    def wait_for_snapshots(self, volumes: list[VolCtx]) -> None:
+        """ Waits until the snapshot of every volume has completed """
+        snapshot_ids = [ctx.snapshot_id for ctx in volumes]
+        self._wait(
+            self._snapshot_created_waiter,
+            SnapshotIds=snapshot_ids
+        )
+        print(f"-- Snapshots: {snapshot_ids} created")
+
+    def create_volume(self, volumes: list[VolCtx], availability_zone: str) -> None:
+        """ Creates an encrypted volume from each snapshot, recording its id on the volume's context """
+        def create(ctx):
+            volume_type = ctx.volume_type
 
             # if volume_type == 'gp2' or volume_type == 'io1' or volume_type == 'standard':
             #     volume_type = 'gp3'
@@ -180,79 +345,85 @@ class EncryptEC2:
                 AvailabilityZone=availability_zone,
                 Encrypted=True,
                 KmsKeyId=self.key,
-                SnapshotId=snapshot,
+                SnapshotId=ctx.snapshot_id,
                 VolumeType=volume_type,
                 TagSpecifications=[
                     {
                         'ResourceType': 'volume',
-                        'Tags': snapshot_resource.tags
+                        'Tags': to_tag_list(ctx.tags)
                     }
                 ]
             )
-            self._ebs_available_waiter.wait(
-                VolumeIds=[
-                    response['VolumeId'],
-                ],
-                WaiterConfig={
-                    'Delay': self._delay,
-                    'MaxAttempts': self._max_attempts
-                }
-            )
-            created_volumes.append(response['VolumeId'])
-        print(f"-- Volumes: {created_volumes} created")
-        return created_volumes
-
-    def attach_volume(self, volume_ids: list) -> bool:
-        for volume in volume_ids:
-            volume_resource = self._ec2_resource.Volume(volume)
-            device_name = ''
-            for tag in volume_resource.tags:
-                if tag['Key'] == 'device-name':
-                    device_name = tag['Value']
+            ctx.new_volume_id = response['VolumeId']
+
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            list(executor.map(create, volumes))
+        volume_ids = [ctx.new_volume_id for ctx in volumes]
+
+        self._wait(
+            self._ebs_available_waiter,
+            VolumeIds=volume_ids
+        )
+        print(f"-- Volumes: {volume_ids} created")
+
+    def attach_volume(self, volumes: list[VolCtx]) -> bool:
+        for ctx in volumes:
             self._ec2_client.attach_volume(
-                Device=device_name,
+                Device=ctx.device_name,
                 InstanceId=self.instance_id,
-                VolumeId=volume
+                VolumeId=ctx.new_volume_id
             )
-        print(f"-- {volume_ids} attached")
+        print(f"-- {[ctx.new_volume_id for ctx in volumes]} attached")
         return True
 
     def start_instance(self):
         self._ec2_client.start_instances(InstanceIds=[self.instance_id])
         print(f"-- Starting {self.instance_id}")
-        self._ec2_status_check_waiter.wait(
+        self._wait(
+            self._ec2_status_check_waiter,
             InstanceIds=[
                 self.instance_id,
-            ],
-            WaiterConfig={
-                'Delay': self._delay,
-                'MaxAttempts': self._max_attempts
-            }
+            ]
         )
         print(f"-- {self.instance_id} has passed 2/2 status checks")
 
-    def delete_snapshots(self, snapshot_list: list):
-        for item in snapshot_list:
+    def delete_snapshots(self, volumes: list[VolCtx]):
+        # DeleteSnapshot has no multi-id form, so fan the calls out instead
+        def delete(ctx):
             self._ec2_client.delete_snapshot(
-                SnapshotId=item
+                SnapshotId=ctx.snapshot_id
             )
-            print(f"-- Snapshot : {item} has been deleted")
+            print(f"-- Snapshot : {ctx.snapshot_id} has been deleted")
+
+        with ThreadPoolExecutor(max_workers=max(1, min(len(volumes), self._max_workers))) as executor:
+            list(executor.map(delete, volumes))
 
     def start_encryption(self):
         if self._pre_checks_passed:
-            volume_ids = [ebs['VolumeId'] for ebs in self.get_ebs_list()]
-            availability_zone = self.get_az()
-            self.stop_instance()
-            self.detach_volume()
-            snapshots = self.create_snapshots(volume_ids=volume_ids)
-            encrypted_volumes = self.create_volume(snapshot_ids=snapshots, availability_zone=availability_zone)
-            self.attach_volume(volume_ids=encrypted_volumes)
+            # Volume contexts gathered during pre checks are reused and filled in by every later step
+            volumes = self._unencrypted_volumes
+            availability_zone = self.availability_zone
+            if self.snapshot_before_stop:
+                # Snapshots progress on the AWS side while the instance stops and the volumes detach
+                self.create_snapshots(volumes=volumes)
+                self.stop_instance()
+                self.detach_volume(volumes=volumes)
+            else:
+                self.stop_instance()
+                self.detach_volume(volumes=volumes)
+                self.create_snapshots(volumes=volumes)
+            self.wait_for_snapshots(volumes=volumes)
+            self.create_volume(volumes=volumes, availability_zone=availability_zone)
+            self.attach_volume(volumes=volumes)
             self.start_instance()
-            self.delete_snapshots(snapshot_list=snapshots)
+            self.delete_snapshots(volumes=volumes)
 
 
 if __name__ == "__main__":
     instance_id = input("Enter instance id: ")
     region_id = input("Enter region: ")
     profile = input("Enter profile: ")
-    EncryptEC2(instance_id=instance_id, region=region_id, profile=profile).start_encryption()
+    snapshot_before_stop = input("Snapshot before stopping (crash-consistent only)? [y/N]: ").strip().lower() == 'y'
+    use_state_events = input("Wait for stop via EventBridge/SQS? [y/N]: ").strip().lower() == 'y'
+    EncryptEC2(instance_id=instance_id, region=region_id, profile=profile,
+               snapshot_before_stop=snapshot_before_stop, use_state_events=use_state_events).start_encryption()